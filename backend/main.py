@@ -1,31 +1,94 @@
 import os
 import asyncio
+import logging
 from contextlib import asynccontextmanager
-from typing import Dict, List
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, Optional, Union
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+import msgspec
+import orjson
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse, Response
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
 from .services.browser_service import BrowserService
 from .services.ai_service import AIService
 from .services.vnc_service import VNCService
+from .services.pubsub_service import PubSubService
 from .websocket_manager import ConnectionManager
+from .static_cache import CachedFile, CachedStaticFiles, respond
 
 load_dotenv()
 
+# Service status goes through logging; LOG_LEVEL=WARNING skips formatting routine messages
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(levelname)s:     %(name)s - %(message)s")
+# httpx logs every LLM request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+STATIC_DIR = Path(__file__).parent / "static"
+
 # Global services
 browser_service: BrowserService = None
 ai_service: AIService = None
 vnc_service: VNCService = None
-connection_manager = ConnectionManager()
+pubsub_service: PubSubService = None
+# Step-update coalescing: flush after WS_BATCH_WINDOW_MS or WS_BATCH_SIZE messages, whichever comes first
+connection_manager = ConnectionManager(
+    batch_window=float(os.getenv("WS_BATCH_WINDOW_MS", "5")) / 1000,
+    batch_size=int(os.getenv("WS_BATCH_SIZE", "32"))
+)
+
+class TaskCreate(BaseModel):
+    """Request body for POST /task"""
+    instruction: str = ""
+
+class TaskExecute(BaseModel):
+    """Request body for POST /execute_task"""
+    task_id: Optional[str] = None
+
+class ExecuteMsg(msgspec.Struct, tag="execute_task"):
+    """WebSocket command: stream execution of a task"""
+    task_id: Optional[str] = None
+
+class VncInfoMsg(msgspec.Struct, tag="get_vnc_info"):
+    """WebSocket command: send VNC connection info"""
+
+# Inbound WebSocket commands, dispatched on their "type" field
+WSMsg = Union[ExecuteMsg, VncInfoMsg]
+_ws_decoder = msgspec.json.Decoder(WSMsg)
+
+class _CommandType(msgspec.Struct):
+    """Just the "type" of a command, to tell bad fields apart from unknown commands"""
+    type: Optional[str] = None
+
+_ws_type_decoder = msgspec.json.Decoder(_CommandType)
+_WS_COMMAND_TYPES = {"execute_task", "get_vnc_info"}
+
+@lru_cache(maxsize=32)
+def _vnc_info_bytes(host: str) -> bytes:
+    """Static VNC info for supervisor-managed VNC setup, serialized once per host"""
+    return orjson.dumps({
+        "type": "vnc_info",
+        "data": {
+            "host": host,
+            "port": 5901,  # Direct VNC port (not used directly, just for display)
+            "display": ":1",
+            "width": 1920,
+            "height": 1080,
+            "ws_url": f"ws://{host}:6901"  # WebSocket VNC port (websockify)
+        }
+    })
+
+# Use localhost for simplicity - works in Docker environment
+_VNC_INFO_BYTES = _vnc_info_bytes("localhost")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
-    global browser_service, ai_service, vnc_service
+    global browser_service, ai_service, vnc_service, pubsub_service
 
     # Startup
     browser_service = BrowserService()
@@ -40,30 +103,42 @@ async def lifespan(app: FastAPI):
 
     # Don't start vnc_service - it's managed by supervisor
 
+    # Share broadcasts across uvicorn workers when Redis is configured
+    if os.getenv("REDIS_URL"):
+        pubsub_service = PubSubService(on_message=connection_manager.local_broadcast)
+        await pubsub_service.start()
+        connection_manager.backplane = pubsub_service
+
     yield
 
     # Shutdown
+    if pubsub_service:
+        connection_manager.backplane = None
+        await pubsub_service.stop()
     await browser_service.stop()
+    await ai_service.aclose()
     # Don't stop vnc_service - it's managed by supervisor
 
 app = FastAPI(
     title="AI Web Agent - Remote Streaming",
     description="Autonomous AI agent with remote browser streaming",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
 )
 
-# CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# CORS middleware - the frontend is same-origin, so only needed for external clients
+if os.getenv("ENABLE_CORS", "false").lower() == "true":
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
 
-# Mount noVNC files
-app.mount("/novnc", StaticFiles(directory="/app/novnc"), name="novnc")
+# Mount noVNC files - unchanged within a deploy, so kept in memory with precompressed variants
+app.mount("/novnc", CachedStaticFiles(directory="/app/novnc"), name="novnc")
 
 @app.get("/api/health")
 async def health_check():
@@ -71,14 +146,14 @@ async def health_check():
     return {"status": "running", "message": "AI Web Agent API is active"}
 
 @app.post("/task")
-async def create_task(task: dict):
+async def create_task(task: TaskCreate):
     """Create a new AI task"""
     try:
-        task_instruction = task.get("instruction", "")
+        task_instruction = task.instruction
         task_id = await ai_service.create_task(task_instruction)
 
-        # Broadcast task creation to all connected clients
-        await connection_manager.broadcast({
+        # Broadcast task creation to all connected clients without delaying the response
+        connection_manager.broadcast_nowait({
             "type": "task_created",
             "task_id": task_id,
             "instruction": task_instruction
@@ -93,29 +168,18 @@ async def create_task(task: dict):
 @app.get("/vnc_info")
 async def get_vnc_info():
     """Get VNC connection information via HTTP"""
-    # Use localhost for simplicity - works in Docker environment
-    host = 'localhost'
-
-    vnc_info = {
-        "host": host,
-        "port": 5901,  # Direct VNC port (not used directly, just for display)
-        "display": ":1",
-        "width": 1920,
-        "height": 1080,
-        "ws_url": f"ws://{host}:6901"  # WebSocket VNC port (websockify)
-    }
-    return {"type": "vnc_info", "data": vnc_info}
+    return Response(content=_VNC_INFO_BYTES, media_type="application/json")
 
 @app.post("/execute_task")
-async def execute_task_http(task: dict):
+async def execute_task_http(task: TaskExecute):
     """Start task execution via HTTP and return task_id for WebSocket streaming"""
     try:
-        task_id = task.get("task_id")
+        task_id = task.task_id
         if not task_id:
             return {"error": "task_id required", "status": "error"}
 
-        # Broadcast start to WebSocket clients
-        await connection_manager.broadcast({
+        # Only the socket executing this task cares; it gets step updates anyway if not yet attached
+        await connection_manager.send_to_task(task_id, {
             "type": "task_execution_started",
             "task_id": task_id
         })
@@ -125,384 +189,100 @@ async def execute_task_http(task: dict):
     except Exception as e:
         return {"error": str(e), "status": "error"}
 
+async def _receive_command(websocket: WebSocket) -> Optional[WSMsg]:
+    """Receive one client command, accepting text or binary frames.
+
+    Binary frames skip the server's UTF-8 decode; msgspec parses straight into a typed
+    struct. Malformed JSON and unknown command types yield None so the caller can ignore
+    them; a known command with badly typed fields is answered with an error frame.
+    """
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    raw = message.get("bytes")
+    data = raw if raw is not None else message["text"]
+    try:
+        return _ws_decoder.decode(data)
+    except msgspec.ValidationError as e:
+        try:
+            command_type = _ws_type_decoder.decode(data).type
+        except msgspec.DecodeError:
+            return None
+        if command_type in _WS_COMMAND_TYPES:
+            await connection_manager.send_personal_message({
+                "type": "error",
+                "message": f"Invalid {command_type} command: {e}"
+            }, websocket)
+        return None
+    except msgspec.DecodeError:
+        return None
+
+async def _stream_task(task_id: str, websocket: WebSocket):
+    """Execute task with AI agent, coalescing bursts of updates into batch frames"""
+    connection_manager.register_task(task_id, websocket)
+    try:
+        await connection_manager.send_batched(ai_service.execute_task(task_id), websocket)
+    finally:
+        connection_manager.unregister_task(task_id, websocket)
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time updates"""
     await connection_manager.connect(websocket)
 
     try:
-        while True:
-            # Listen for messages from client
-            data = await websocket.receive_json()
-
-            if data.get("type") == "execute_task":
-                task_id = data.get("task_id")
-                if not task_id:
-                    await connection_manager.send_personal_message({
-                        "type": "error",
-                        "message": "task_id is required for execute_task"
-                    }, websocket)
-                    continue
-
-                # Execute task with AI agent
-                async for update in ai_service.execute_task(task_id):
-                    await connection_manager.send_personal_message(update, websocket)
-
-            elif data.get("type") == "get_vnc_info":
-                # Static VNC info for supervisor-managed VNC setup
-                # Use the same host as the API request came from
-                host = websocket.headers.get('host', 'localhost').split(':')[0]
-                vnc_info = {
-                    "host": host,
-                    "port": 5901,  # Direct VNC port (not used directly, just for display)
-                    "display": ":1",
-                    "width": 1920,
-                    "height": 1080,
-                    "ws_url": f"ws://{host}:6901"  # WebSocket VNC port (websockify)
-                }
-                await connection_manager.send_personal_message({
-                    "type": "vnc_info",
-                    "data": vnc_info
-                }, websocket)
-
-    except WebSocketDisconnect:
+        # Task streams run beside the receive loop, so a disconnect is seen immediately
+        # and the TaskGroup cancels (and thereby closes) any in-flight AI generator
+        async with asyncio.TaskGroup() as task_group:
+            while True:
+                # Listen for messages from client
+                command = await _receive_command(websocket)
+
+                if isinstance(command, ExecuteMsg):
+                    task_id = command.task_id
+                    if not task_id:
+                        await connection_manager.send_personal_message({
+                            "type": "error",
+                            "message": "task_id is required for execute_task"
+                        }, websocket)
+                        continue
+
+                    task_group.create_task(_stream_task(task_id, websocket))
+
+                elif isinstance(command, VncInfoMsg):
+                    # Use the same host as the API request came from (resolved once at connect)
+                    await connection_manager.send_serialized(_vnc_info_bytes(websocket.state.host), websocket)
+
+    except* WebSocketDisconnect:
+        pass
+    finally:
         connection_manager.disconnect(websocket)
 
-@app.get("/", response_class=HTMLResponse)
-async def frontend():
-    """Embedded frontend with noVNC client - no static files needed!"""
-    return HTMLResponse(content="""<!DOCTYPE html>
-<html>
-<head>
-    <title>AI Web Agent - With VNC Streaming</title>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <!-- Load noVNC using proper ES6 modules -->
-    <style>
-        body { font-family: monospace; margin: 20px; background: #1a1a1a; color: #00ff00; }
-        .container { max-width: 1400px; margin: 0 auto; }
-        h1 { color: #00ffff; text-align: center; margin-bottom: 20px; }
-        .status { padding: 15px; margin: 10px 0; border-radius: 8px; font-weight: bold; }
-        .status.connected { background: #0f4f0f; color: #00ff00; }
-        .status.error { background: #4f0f0f; color: #ff6666; }
-        .status.info { background: #0f0f4f; color: #6666ff; }
-        .controls { margin: 20px 0; display: flex; gap: 10px; align-items: center; }
-        input { flex: 1; padding: 12px; background: #333; border: 1px solid #555; color: #00ff00; font-family: inherit; }
-        button { padding: 12px 20px; background: #0066cc; color: white; border: none; cursor: pointer; font-weight: bold; }
-        .vnc-display {
-            background: #000;
-            min-height: 600px;
-            border: 2px solid #333;
-            margin: 20px 0;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            color: white;
-            position: relative;
-        }
-        .vnc-container {
-            width: 100%;
-            height: 600px;
-            position: relative;
-            overflow: hidden;
-        }
-        #vnc-screen {
-            width: 100%;
-            height: 100%;
-            display: block;
-        }
-        .vnc-controls {
-            position: absolute;
-            top: 10px;
-            right: 10px;
-            z-index: 1000;
-            display: flex;
-            gap: 5px;
-        }
-        .vnc-btn {
-            padding: 5px 10px;
-            background: rgba(0,100,200,0.8);
-            color: white;
-            border: none;
-            border-radius: 3px;
-            font-size: 11px;
-            cursor: pointer;
-        }
-        .logs { background: #111; border: 1px solid #333; padding: 10px; height: 200px; overflow-y: auto; font-size: 12px; margin-top: 20px; }
-    </style>
-</head>
-<body>
-    <div class="container">
-        <h1>🚀 AI Web Agent - Ultra Simple</h1>
-        <div id="status" class="status info">Initializing...</div>
-
-        <div class="controls">
-            <input type="text" id="taskInput" placeholder="Enter AI task (e.g., search iPhone 17)" onkeydown="if(event.key==='Enter') submitTask()">
-            <button onclick="submitTask()">🚀 Execute</button>
-            <button onclick="connectVNC()">🖥️ Connect VNC</button>
-        </div>
-
-        <div id="vnc-display" class="vnc-display">
-            <div id="vnc-startup-msg" style="text-align: center;">
-                <div style="font-size: 48px; margin-bottom: 20px;">🖥️</div>
-                <div>Remote Browser Display</div>
-                <div style="margin-top: 10px;">Click "Connect VNC" to start streaming</div>
-            </div>
-            <div id="vnc-container" class="vnc-container" style="display: none;">
-                <div class="vnc-controls">
-                    <button class="vnc-btn" onclick="disconnectVNC()">Disconnect</button>
-                    <button class="vnc-btn" onclick="takeScreenshot()">Screenshot</button>
-                </div>
-                <div id="vnc-screen" style="width: 100%; height: 100%; background: #000;"></div>
-            </div>
-        </div>
-
-        <div id="logs" class="logs"></div>
-    </div>
-
-    <script>
-        let ws = null;
-        let vncInfo = null;
-        let rfb = null;
-        let RFB = null;
-
-        // Import RFB dynamically and expose functions globally
-        import('/novnc/core/rfb.js').then(module => {
-            RFB = module.default;
-            console.log('RFB module loaded successfully');
-        }).catch(err => {
-            console.error('Failed to load RFB module:', err);
-        });
-
-        function log(msg) {
-            const logs = document.getElementById('logs');
-            const time = new Date().toLocaleTimeString();
-            logs.innerHTML += `[${time}] ${msg}\\n`;
-            logs.scrollTop = logs.scrollHeight;
-            console.log(msg);
-        }
-
-        function updateStatus(status, type = 'info') {
-            const statusEl = document.getElementById('status');
-            statusEl.textContent = status;
-            statusEl.className = `status ${type}`;
-            log(`STATUS: ${status}`);
-        }
-
-        function connectedToServer(e) {
-            log('✅ VNC connected successfully!');
-            updateStatus('VNC Connected - Browser streaming active', 'connected');
-        }
-
-        function disconnectedFromServer(e) {
-            if (e.detail.clean) {
-                log('🔌 VNC disconnected cleanly');
-                updateStatus('VNC Disconnected', 'error');
-            } else {
-                log('❌ VNC connection lost unexpectedly');
-                updateStatus('VNC Connection Lost', 'error');
-            }
-            showStartupMessage();
-        }
-
-        function credentialsRequired(e) {
-            log('🔐 VNC credentials required');
-            // Send empty password since VNC server has no password
-            rfb.sendCredentials({ password: '' });
-        }
-
-        async function connectVNC() {
-            try {
-                log('📡 Getting VNC info...');
-                const response = await fetch('/vnc_info');
-                const data = await response.json();
-
-                if (data.type === 'vnc_info' && data.data) {
-                    vncInfo = data.data;
-                    log(`✅ VNC info received: ${vncInfo.ws_url}`);
-
-                    // Hide startup message and show VNC container
-                    document.getElementById('vnc-startup-msg').style.display = 'none';
-                    document.getElementById('vnc-container').style.display = 'block';
-
-                    // Create RFB connection using official example pattern
-                    const target = document.getElementById('vnc-screen');
-                    
-                    // Use WebSocket URL from backend, but replace hostname for remote access
-                    const remoteUrl = new URL(vncInfo.ws_url);
-                    remoteUrl.hostname = window.location.hostname;
-                    const url = remoteUrl.toString();
-
-                    log(`🔄 Connecting to VNC: ${url}`);
-                    updateStatus('Connecting to VNC...', 'info');
-
-                    if (!RFB) {
-                        log('❌ RFB not loaded yet, retrying in 1 second...');
-                        setTimeout(() => connectVNC(), 1000);
-                        return;
-                    }
-
-                    rfb = new RFB(target, url);
-
-                    // Event listeners based on official documentation
-                    rfb.addEventListener('connect', connectedToServer);
-                    rfb.addEventListener('disconnect', disconnectedFromServer);
-                    rfb.addEventListener('credentialsrequired', credentialsRequired);
-
-                    // Optional settings
-                    rfb.scaleViewport = true;
-                    rfb.resizeSession = false;
-                }
-            } catch (error) {
-                log(`❌ Failed to connect VNC: ${error.message}`);
-                updateStatus('VNC Connection Failed', 'error');
-                showStartupMessage();
-            }
-        }
-
-        function disconnectVNC() {
-            if (rfb) {
-                log('🔌 Disconnecting VNC...');
-                rfb.disconnect();
-                rfb = null;
-            }
-            showStartupMessage();
-        }
-
-        function showStartupMessage() {
-            document.getElementById('vnc-startup-msg').style.display = 'block';
-            document.getElementById('vnc-container').style.display = 'none';
-        }
-
-        function takeScreenshot() {
-            if (rfb) {
-                log('📸 Taking screenshot...');
-                // Find the canvas element inside the noVNC display
-                const vncCanvas = document.querySelector('#vnc-screen canvas');
-                if (vncCanvas) {
-                    const dataURL = vncCanvas.toDataURL('image/png');
-                    const link = document.createElement('a');
-                    link.download = `vnc-screenshot-${new Date().toISOString().slice(0,19)}.png`;
-                    link.href = dataURL;
-                    link.click();
-                    log('✅ Screenshot saved');
-                } else {
-                    log('❌ No canvas found for screenshot');
-                }
-            }
-        }
-
-        function connectWebSocket(onOpenCallback) {
-            if (ws && ws.readyState === WebSocket.OPEN) {
-                if(onOpenCallback) onOpenCallback();
-                return;
-            }
-
-            log('🔄 Connecting WebSocket...');
-            const wsProtocol = location.protocol === 'https:' ? 'wss:' : 'ws:';
-            const wsUrl = `${wsProtocol}//${location.host}/ws`;
-            ws = new WebSocket(wsUrl);
-            log(`Connecting to: ${wsUrl}`);
-
-            ws.onopen = () => {
-                log('✅ WebSocket connected!');
-                updateStatus('WebSocket Connected', 'connected');
-                if (onOpenCallback) onOpenCallback();
-            };
-
-            ws.onmessage = (event) => {
-                const data = JSON.parse(event.data);
-                log(`📥 ${data.type}: ${data.description || data.message || JSON.stringify(data)}`);
-
-                if (data.type === 'step_update') {
-                    updateStatus(`Step ${data.step_number}: ${data.description}`, 'info');
-                } else if (data.type === 'task_complete') {
-                    updateStatus('Task Completed!', 'connected');
-                }
-            };
-
-            ws.onerror = () => {
-                log('❌ WebSocket error');
-                updateStatus('WebSocket Error', 'error');
-            };
-
-            ws.onclose = () => {
-                log('🔌 WebSocket closed');
-                updateStatus('WebSocket Disconnected', 'error');
-            };
-        }
-
-        async function submitTask() {
-            const input = document.getElementById('taskInput');
-            const task = input.value.trim();
-            if (!task) return;
-
-            log(`🚀 Submitting task: ${task}`);
-
-            try {
-                // Create task
-                const response = await fetch('/task', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ instruction: task })
-                });
-
-                if (!response.ok) {
-                    throw new Error(`HTTP ${response.status}: ${response.statusText}`);
-                }
-
-                const taskData = await response.json();
-                log(`✅ Task created: ${taskData.task_id}`);
-
-                // Start execution
-                const executeResponse = await fetch('/execute_task', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ task_id: taskData.task_id })
-                });
-
-                if (executeResponse.ok) {
-                    log(`🚀 Task execution started`);
-                    updateStatus('Task Executing...', 'info');
-
-                    // Connect WebSocket for updates and send execute command on open
-                    connectWebSocket(() => {
-                        if (ws && ws.readyState === WebSocket.OPEN) {
-                             ws.send(JSON.stringify({
-                                type: 'execute_task',
-                                task_id: taskData.task_id
-                            }));
-                        }
-                    });
-                }
-
-                input.value = '';
-
-            } catch (error) {
-                log(`❌ Task failed: ${error.message}`);
-                updateStatus('Task Failed', 'error');
-            }
-        }
+# Frontend is loaded once at import; compressed bodies and ETags are precomputed so requests only pick a variant
+_FRONTEND = CachedFile.from_bytes((STATIC_DIR / "index.html").read_bytes(), "text/html; charset=utf-8")
 
-        // Initialize
-        document.addEventListener('DOMContentLoaded', () => {
-            log('🚀 AI Web Agent initialized');
-            updateStatus('Ready - Click "Connect VNC" to start streaming', 'connected');
-
-            // Auto-connect VNC on startup
-            setTimeout(() => {
-                connectVNC();
-            }, 1000);
-        });
-    </script>
-</body>
-</html>""")
+@app.get("/", response_class=HTMLResponse)
+async def frontend(request: Request):
+    """Frontend with noVNC client, served precompressed with an ETag"""
+    return respond(_FRONTEND, request.headers, "public, max-age=300")
 
 if __name__ == "__main__":
     import uvicorn
+    # DEV=1 trades the production tuning for auto-reload (reload needs one worker and the default loop)
+    dev = os.getenv("DEV") == "1"
     uvicorn.run(
         "main:app",
         host=os.getenv("API_HOST", "0.0.0.0"),
         port=int(os.getenv("API_PORT", 8000)),
-        reload=True
-    )
\ No newline at end of file
+        loop="auto" if dev else "uvloop",
+        http="httptools",
+        ws="websockets",
+        # Batched step updates are repetitive JSON, so permessage-deflate pays off on the wire
+        ws_per_message_deflate=os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true",
+        ws_ping_interval=20,
+        ws_ping_timeout=20,
+        timeout_keep_alive=75,
+        backlog=2048,
+        workers=1 if dev else int(os.getenv("WEB_CONCURRENCY", 1)),
+        reload=dev
+    )
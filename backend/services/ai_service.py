@@ -1,97 +1,299 @@
 import asyncio
+import hashlib
+import io
+import itertools
+import logging
 import os
-import uuid
-from typing import Dict, AsyncGenerator, Optional
+import secrets
+import time
+from collections import OrderedDict
+from operator import attrgetter
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, AsyncGenerator, List, Optional, Tuple
+
+import httpx
 from openai import AsyncOpenAI
 
+from .plan_cache import PlanCache
+
+logger = logging.getLogger(__name__)
+
+try:
+    # SIMD base64 encoder (AVX2/SSSE3); returns str without a separate bytes->str copy
+    from pybase64 import b64encode_as_string
+except ImportError:
+    import base64
+
+    def b64encode_as_string(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
+
+# Model used for each provider (works with both OpenAI and OpenRouter)
+PROVIDER_MODELS = {"openrouter": "google/gemini-2.5-flash", "openai": "gpt-4o"}
+
+
+def detect_provider(base_url: str) -> str:
+    """Provider behind an OpenAI-compatible base URL"""
+    return "openrouter" if "openrouter" in base_url else "openai"
+
+
+# Static, byte-stable prefix of every analysis request so providers can cache it
+SYSTEM_PROMPT = "You are an AI agent that controls web browsers. Analyze the current state and provide the next action to take."
+_SYS_MSG = {"role": "system", "content": SYSTEM_PROMPT}
+# Explicit prompt-cache breakpoint on the static prefix only, for OpenRouter; OpenAI caches prefixes automatically
+_SYS_MSG_CACHED = {
+    "role": "system",
+    "content": [{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}]
+}
+
+
+SCREENSHOT_FORMATS = ("jpeg", "webp", "png")
+
+
+def _screenshot_format(value: str) -> str:
+    """Normalise SCREENSHOT_FORMAT, falling back to jpeg for anything Pillow cannot write"""
+    fmt = value.strip().lower()
+    if fmt == "jpg":
+        return "jpeg"
+    if fmt not in SCREENSHOT_FORMATS:
+        logger.warning("Unsupported SCREENSHOT_FORMAT %r, using jpeg", value)
+        return "jpeg"
+    return fmt
+
+
+def compress_screenshot(data: bytes, fmt: str = "jpeg", quality: int = 80) -> Tuple[str, bytes]:
+    """Re-encode a PNG screenshot as JPEG/WebP; returns (media type, bytes)"""
+    if fmt == "png" or not data.startswith(b"\x89PNG"):
+        # Keep lossless PNG on request, and pass through images that are already compressed
+        if data.startswith(b"\xff\xd8"):
+            return "image/jpeg", data
+        if data[8:12] == b"WEBP":
+            return "image/webp", data
+        return "image/png", data
+
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG has no alpha channel
+        image = image.convert("RGB") if fmt == "jpeg" else image
+        image.save(buffer, fmt.upper(), quality=quality)
+    return f"image/{fmt}", buffer.getvalue()
+
+
+def _probe_goal_reader(sample) -> Callable[[Any], str]:
+    """Work out where a browser-use output class keeps its next goal"""
+    if hasattr(sample, "next_goal"):
+        return attrgetter("next_goal")
+    if hasattr(getattr(sample, "current_state", None), "next_goal"):
+        # Older browser-use releases nest the reasoning under current_state
+        return attrgetter("current_state.next_goal")
+    return lambda output: ""
+
+
+# Goal reader per step-output class, probed on the first step of that class
+_GOAL_READERS: Dict[type, Callable[[Any], str]] = {}
+
+
+@dataclass(slots=True)
+class TaskRecord:
+    """State of a single AI task"""
+    id: str
+    instruction: str
+    status: str = "created"
+    steps: List[Dict] = field(default_factory=list)
+    result: Any = None
+
+    def to_dict(self) -> Dict:
+        """JSON-ready view of the task; steps are shared, not deep-copied like asdict()"""
+        return {
+            "id": self.id,
+            "instruction": self.instruction,
+            "status": self.status,
+            "steps": self.steps,
+            "result": self.result
+        }
+
 
 class AIService:
     """Service for managing AI agents and task execution"""
 
     def __init__(self, browser_service=None):
         self.openai_client: Optional[AsyncOpenAI] = None
-        self.tasks: Dict[str, Dict] = {}
+        self.http_client: Optional[httpx.AsyncClient] = None
+        # Insertion-ordered so the oldest tasks are evicted first once max_tasks is exceeded
+        self.tasks: "OrderedDict[str, TaskRecord]" = OrderedDict()
+        self.max_tasks = int(os.getenv("MAX_TASKS", "1024"))
+        # Task history keeps only step metadata unless descriptions are asked for
+        self.keep_step_descriptions = os.getenv("KEEP_STEP_DESCRIPTIONS", "false").lower() == "true"
         self.current_running_task: Optional[str] = None
         self.browser_service = browser_service
+        # Serializes the running-task check-and-set across create/execute
+        self._task_lock = asyncio.Lock()
+        # Short task ids: a counter plus a per-process salt so ids never repeat across restarts
+        self._next_id = itertools.count(1)
+        self._id_salt = secrets.token_hex(4)
+        # In-flight analyses by request hash, so identical concurrent calls share one LLM request
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+        # Replays steps of an identical earlier run instead of invoking the agent (opt-in)
+        self.plan_cache: Optional[PlanCache] = None
+        if os.getenv("PLAN_CACHE", "false").lower() == "true":
+            self.plan_cache = PlanCache(
+                os.getenv("PLAN_CACHE_PATH", "/tmp/plan_cache.json"),
+                ttl=float(os.getenv("PLAN_CACHE_TTL_DAYS", "7")) * 24 * 3600
+            )
 
         # Initialize AI client (OpenRouter via OpenAI-compatible API)
         openai_api_key = os.getenv("OPENAI_API_KEY")
         openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+        # Screenshots sent to the vision model; use png for OCR-sensitive tasks
+        self.screenshot_format = _screenshot_format(os.getenv("SCREENSHOT_FORMAT", "jpeg"))
+        self.screenshot_quality = int(os.getenv("SCREENSHOT_QUALITY", "80"))
+        # Resolved once; analyze_with_openai runs per AI step
+        self.provider = detect_provider(openai_base_url)
+        self.model = PROVIDER_MODELS[self.provider]
+        self.system_message = _SYS_MSG_CACHED if self.provider == "openrouter" else _SYS_MSG
 
         if openai_api_key:
+            # One pooled HTTP/2 client so every step reuses warm, multiplexed connections
+            self.http_client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_keepalive_connections=64, max_connections=128),
+                timeout=60.0
+            )
             self.openai_client = AsyncOpenAI(
                 api_key=openai_api_key,
-                base_url=openai_base_url
+                base_url=openai_base_url,
+                http_client=self.http_client
             )
 
+    async def aclose(self):
+        """Close the pooled HTTP client"""
+        if self.http_client:
+            await self.http_client.aclose()
+
     async def create_task(self, instruction: str) -> str:
         """Create a new AI task"""
-        # Check if there's already a running task
-        if self.current_running_task and self.current_running_task in self.tasks:
-            current_task = self.tasks[self.current_running_task]
-            if current_task["status"] == "running":
+        async with self._task_lock:
+            # Check if there's already a running task
+            if self.is_task_running():
                 raise ValueError("Cannot create new task: another task is currently running")
 
-        task_id = str(uuid.uuid4())
+            task_id = f"t{next(self._next_id):x}-{self._id_salt}"
 
-        self.tasks[task_id] = {
-            "id": task_id,
-            "instruction": instruction,
-            "status": "created",
-            "steps": [],
-            "result": None
-        }
+            self.tasks[task_id] = TaskRecord(id=task_id, instruction=instruction)
+            self._evict_old_tasks()
 
         return task_id
 
+    def _evict_old_tasks(self):
+        """Drop the oldest tasks (and their step history) beyond max_tasks, keeping the running one"""
+        while len(self.tasks) > self.max_tasks:
+            oldest = next(iter(self.tasks))
+            if oldest == self.current_running_task:
+                self.tasks.move_to_end(oldest)
+                oldest = next(iter(self.tasks))
+            del self.tasks[oldest]
+
     async def execute_task(self, task_id: str) -> AsyncGenerator[Dict, None]:
         """Execute a task with browser-use agent"""
-        if task_id not in self.tasks:
-            yield {"type": "error", "message": "Task not found"}
+        # Claim the running slot atomically; the lock is released before any yield
+        async with self._task_lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                error = "Task not found"
+            elif task.status == "running" or self.current_running_task == task_id:
+                # A second execute for the same task would drive the browser twice
+                error = "Task is already running"
+            elif self.current_running_task:
+                # Another task is already running
+                error = "Another task is currently running"
+            else:
+                error = None
+                task.status = "running"
+                self.current_running_task = task_id
+
+        if error:
+            yield {"type": "error", "message": error}
             return
 
-        # Check if another task is already running
-        if self.current_running_task and self.current_running_task != task_id:
-            yield {"type": "error", "message": "Another task is currently running"}
-            return
-
-        task = self.tasks[task_id]
-        task["status"] = "running"
-        self.current_running_task = task_id
-
-        yield {
-            "type": "task_update",
-            "task_id": task_id,
-            "status": "running",
-            "message": "Starting task execution..."
-        }
-
         try:
+            yield {
+                "type": "task_update",
+                "task_id": task_id,
+                "status": "running",
+                "message": "Starting task execution..."
+            }
+
             # Use the centralized browser service
             if not self.browser_service:
                 raise ValueError("Browser service not available")
 
-            # Execute the task and stream updates
-            async for step in self._execute_browser_task(task["instruction"], task_id):
-                yield step
+            plan_key = None
+            cached = None
+            if self.plan_cache:
+                url = await self.browser_service.get_current_url()
+                # Without a known starting page a cached plan could replay against any page
+                if url:
+                    plan_key = PlanCache.fingerprint(task.instruction, url)
+                    cached = self.plan_cache.get(plan_key)
+
+            if cached is not None:
+                # Same instruction from the same page already succeeded - skip the LLM loop
+                for step in cached["steps"]:
+                    step = {**step, "task_id": task_id, "cached": True}
+                    task.steps.append(self._step_record(step))
+                    yield step
+                task.result = cached.get("result")
+            else:
+                # Execute the task and stream updates
+                failed = False
+                # Full step messages are only kept when the plan cache needs them for replay
+                replay: Optional[List[Dict]] = [] if plan_key else None
+                async for step in self._execute_browser_task(task.instruction, task_id):
+                    if step["type"] == "step_update":
+                        task.steps.append(self._step_record(step))
+                        if replay is not None:
+                            replay.append(step)
+                    else:
+                        failed = True
+                    yield step
+
+                # Only runs browser-use judged successful are worth replaying
+                if plan_key and not failed and self._run_succeeded(task.result):
+                    self.plan_cache.put(plan_key, replay, task.result.final_result())
+                    try:
+                        await asyncio.to_thread(self.plan_cache.save)
+                    except Exception as e:
+                        # The run itself succeeded; only persisting it for replay failed
+                        logger.warning("Could not save plan cache: %s", e)
 
             # Mark task as completed
-            task["status"] = "completed"
+            task.status = "completed"
             self.current_running_task = None  # Clear running task
-            yield {
-                "type": "task_complete",
-                "task_id": task_id,
-                "status": "completed"
-            }
+
+        except (asyncio.CancelledError, GeneratorExit):
+            # Consumer went away (e.g. WebSocket closed) - release the running slot
+            task.status = "cancelled"
+            self.current_running_task = None
+            raise
 
         except Exception as e:
-            task["status"] = "failed"
+            task.status = "failed"
             self.current_running_task = None  # Clear running task
             yield {
                 "type": "error",
                 "task_id": task_id,
                 "message": f"Task execution failed: {str(e)}"
             }
+            return
+
+        # Yielded outside the try so a consumer closing here leaves the task completed
+        yield {
+            "type": "task_complete",
+            "task_id": task_id,
+            "status": "completed"
+        }
 
     async def _execute_browser_task(self, instruction: str, task_id: str) -> AsyncGenerator[Dict, None]:
         """Execute browser task using centralized browser service with streaming updates"""
@@ -105,39 +307,92 @@ class AIService:
                 "description": "Starting browser automation with browser-use agent..."
             }
 
-            # Execute task using browser service
-            result = await self.browser_service.execute_task(instruction, max_steps=10)
+            # Run the agent in the background and stream each step as the agent finishes it
+            steps: asyncio.Queue = asyncio.Queue()
+
+            def on_step(state, model_output, step_number):
+                steps.put_nowait(self._agent_step_update(task_id, model_output, step_number + 1))
+
+            run = asyncio.create_task(
+                self.browser_service.execute_task(instruction, max_steps=10, on_step=on_step)
+            )
+            # None marks the end of the run, after every step queued before it
+            run.add_done_callback(lambda _: steps.put_nowait(None))
+            step_number = 1
+            try:
+                while (step := await steps.get()) is not None:
+                    step_number = step["step_number"]
+                    yield step
+            finally:
+                # Consumer went away mid-run - stop the agent too
+                run.cancel()
+            result = run.result()
 
             # Yield completion message
             yield {
                 "type": "step_update",
                 "task_id": task_id,
-                "step_number": 2,
+                "step_number": step_number + 1,
                 "action": "completed",
                 "description": f"Task completed successfully. Result: {str(result)[:200] if result else 'No result returned'}"
             }
 
             # Store the result
-            self.tasks[task_id]["result"] = result
+            self.tasks[task_id].result = result
 
         except Exception as e:
             error_msg = f"Browser task execution error: {str(e)}"
-            print(f"DEBUG: {error_msg}")  # Debug logging
+            logger.error(error_msg)
             yield {
                 "type": "step_error",
                 "task_id": task_id,
                 "message": error_msg
             }
 
+    @staticmethod
+    def _run_succeeded(result) -> bool:
+        """True when the agent history reports the task as done and successful"""
+        try:
+            return bool(result.is_done() and result.is_successful())
+        except AttributeError:
+            return False
+
+    def _step_record(self, step: Dict) -> Dict:
+        """What a task keeps of a streamed step once it has been sent"""
+        if self.keep_step_descriptions:
+            return step
+        return {"step_number": step["step_number"], "action": step["action"], "ts": time.time()}
+
+    @staticmethod
+    def _agent_step_update(task_id: str, model_output, step_number: int) -> Dict:
+        """Turn a browser-use step callback into a step_update message"""
+        actions = [
+            name
+            for action in (getattr(model_output, "action", None) or [])
+            for name in action.model_dump(exclude_none=True)
+        ]
+        read_goal = _GOAL_READERS.get(type(model_output))
+        if read_goal is None:
+            read_goal = _GOAL_READERS[type(model_output)] = _probe_goal_reader(model_output)
+        goal = read_goal(model_output)
+        return {
+            "type": "step_update",
+            "task_id": task_id,
+            "step_number": step_number,
+            "action": ", ".join(actions) or "thinking",
+            "description": goal or ""
+        }
+
     async def get_task_status(self, task_id: str) -> Optional[Dict]:
         """Get current task status"""
-        return self.tasks.get(task_id)
+        task = self.tasks.get(task_id)
+        return task.to_dict() if task else None
 
     def is_task_running(self) -> bool:
         """Check if any task is currently running"""
         return (self.current_running_task is not None and
                 self.current_running_task in self.tasks and
-                self.tasks[self.current_running_task]["status"] == "running")
+                self.tasks[self.current_running_task].status == "running")
 
     def get_running_task_id(self) -> Optional[str]:
         """Get the ID of the currently running task"""
@@ -150,41 +405,49 @@ class AIService:
         if not self.openai_client:
             return "OpenAI client not available"
 
-        try:
-            messages = [
+        # Non-cryptographic fingerprint; only needs to tell concurrent requests apart
+        digest = hashlib.blake2b(prompt.encode(), digest_size=16)
+        if screenshot_data:
+            digest.update(screenshot_data)
+        key = digest.hexdigest()
+
+        request = self._inflight.get(key)
+        if request is None:
+            request = asyncio.create_task(self._analyze(prompt, screenshot_data))
+            self._inflight[key] = request
+            request.add_done_callback(lambda _: self._inflight.pop(key, None))
+
+        # Shielded so one caller going away does not cancel the request for the others
+        return await asyncio.shield(request)
+
+    async def _image_message(self, screenshot_data: bytes) -> Dict:
+        """Screenshot as a data-URL image message, shrunk off the event loop first"""
+        media_type, image_data = await asyncio.to_thread(
+            compress_screenshot, screenshot_data, self.screenshot_format, self.screenshot_quality
+        )
+        return {
+            "role": "user",
+            "content": [
                 {
-                    "role": "system",
-                    "content": "You are an AI agent that controls web browsers. Analyze the current state and provide the next action to take."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{media_type};base64,{b64encode_as_string(image_data)}"
+                    }
                 }
             ]
+        }
 
-            # Add screenshot if provided
+    async def _analyze(self, prompt: str, screenshot_data: Optional[bytes]) -> str:
+        """Send one analysis request to the model"""
+        try:
+            user_message = {"role": "user", "content": prompt}
             if screenshot_data:
-                # Convert screenshot to base64 and add to message
-                import base64
-                screenshot_b64 = base64.b64encode(screenshot_data).decode()
-                messages.append({
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{screenshot_b64}"
-                            }
-                        }
-                    ]
-                })
-
-            # Use the same model selection logic
-            openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-            model = "google/gemini-2.5-flash" if "openrouter" in openai_base_url else "gpt-4o"
+                messages = [self.system_message, user_message, await self._image_message(screenshot_data)]
+            else:
+                messages = [self.system_message, user_message]
 
             response = await self.openai_client.chat.completions.create(
-                model=model,
+                model=self.model,
                 messages=messages,
                 max_tokens=1000
             )
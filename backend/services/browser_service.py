@@ -1,8 +1,40 @@
 import asyncio
+import logging
 import os
+from dataclasses import dataclass, field
+from functools import lru_cache
 from typing import Optional
+
+import httpx
+import orjson
 from browser_use import Agent, ChatOpenAI, Browser
 
+from .ai_service import PROVIDER_MODELS, detect_provider
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class BrowserConfig:
+    """Browser and LLM settings from the environment"""
+    headless: bool
+    width: int
+    height: int
+    openai_api_key: Optional[str] = field(repr=False)
+    openai_base_url: str
+
+
+@lru_cache(maxsize=1)
+def load_browser_config() -> BrowserConfig:
+    """Read the settings once; deferred to first use so main.py's load_dotenv() has run"""
+    return BrowserConfig(
+        headless=os.getenv("BROWSER_HEADLESS", "false").lower() == "true",
+        width=int(os.getenv("BROWSER_WIDTH", "1920")),
+        height=int(os.getenv("BROWSER_HEIGHT", "1080")),
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        openai_base_url=os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+    )
+
 
 class BrowserService:
     """Service for managing browser automation using browser-use"""
@@ -11,11 +43,14 @@ class BrowserService:
         self.agent: Optional[Agent] = None
         self.browser: Optional[Browser] = None
         self.llm: Optional[ChatOpenAI] = None
+        self.llm_http_client: Optional[httpx.AsyncClient] = None
+        # One keep-alive session for every DevTools HTTP/websocket request
+        self.http_session = None
 
         # Configuration from environment
-        self.headless = os.getenv("BROWSER_HEADLESS", "false").lower() == "true"
-        self.width = int(os.getenv("BROWSER_WIDTH", "1920"))
-        self.height = int(os.getenv("BROWSER_HEIGHT", "1080"))
+        self.config = load_browser_config()
+        self.provider = detect_provider(self.config.openai_base_url)
+        self.model = PROVIDER_MODELS[self.provider]
 
     async def start(self):
         """Initialize browser-use agent with connection to existing Chrome debug port"""
@@ -23,24 +58,25 @@ class BrowserService:
             # Ensure browser runs on VNC display
             os.environ["DISPLAY"] = ":1"
 
-            # Initialize browser-use agent with AI provider
-            openai_api_key = os.getenv("OPENAI_API_KEY")
-            openai_base_url = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
-
-            if openai_api_key:
-                # Use Gemini 2.5 Flash model (works with both OpenAI and OpenRouter)
-                model = "google/gemini-2.5-flash" if "openrouter" in openai_base_url else "gpt-4o"
-
+            # One LLM client shared by every per-task agent
+            if self.config.openai_api_key:
+                # Pooled HTTP/2 connections stay warm across agent steps, so only the first call pays for TLS
+                self.llm_http_client = httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(max_keepalive_connections=10, keepalive_expiry=300.0),
+                    timeout=60.0
+                )
                 self.llm = ChatOpenAI(
-                    model=model,
-                    api_key=openai_api_key,
-                    base_url=openai_base_url
+                    model=self.model,
+                    api_key=self.config.openai_api_key,
+                    base_url=self.config.openai_base_url,
+                    http_client=self.llm_http_client
                 )
             else:
                 raise Exception("No OPENAI_API_KEY configured")
 
             # Wait for Chrome debug port to be ready
-            print("Waiting for Chrome debug port...")
+            logger.info("Waiting for Chrome debug port...")
             await self._wait_for_debug_port()
 
             # Create Browser instance to CONNECT to existing Chrome with debug port
@@ -51,23 +87,28 @@ class BrowserService:
             )
 
             # Do not create a long-lived agent. One will be created per task.
-            print("Browser service initialized and connected to Chrome.")
+            logger.info("Browser service initialized and connected to Chrome.")
 
         except Exception as e:
-            print(f"Error starting browser service: {e}")
+            logger.error("Error starting browser service: %s", e)
             raise
 
     async def stop(self):
         """Clean up browser resources"""
         try:
+            if self.http_session:
+                await self.http_session.close()
+            if self.llm_http_client:
+                await self.llm_http_client.aclose()
+
             # We don't kill the browser here because it's managed externally
             # and we want to reuse it. The keep_alive=True flag is important.
-            print("Browser service stopped, but browser remains alive for reuse.")
+            logger.info("Browser service stopped, but browser remains alive for reuse.")
         except Exception as e:
-            print(f"Error stopping browser service: {e}")
+            logger.error("Error stopping browser service: %s", e)
 
-    async def execute_task(self, instruction: str, max_steps: int = 10):
-        """Execute a task using browser-use agent"""
+    async def execute_task(self, instruction: str, max_steps: int = 10, on_step=None):
+        """Execute a task using browser-use agent, calling on_step(state, output, n) after each step"""
         if not self.browser or not self.llm:
             raise Exception("Browser service not started")
 
@@ -76,35 +117,72 @@ class BrowserService:
             agent = Agent(
                 task=instruction,
                 llm=self.llm,
-                browser=self.browser
+                browser=self.browser,
+                register_new_step_callback=on_step
             )
 
             # Execute the task
             result = await agent.run(max_steps=max_steps)
             return result
         except Exception as e:
-            print(f"Error executing task: {e}")
+            logger.error("Error executing task: %s", e)
             raise
 
-    async def _wait_for_debug_port(self, max_retries=10):
-        """Wait for Chrome debug port to be ready"""
+    def _session(self):
+        """Shared DevTools HTTP session, created on first use"""
         import aiohttp
 
-        for attempt in range(max_retries):
+        if self.http_session is None or self.http_session.closed:
+            self.http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=2),
+                connector=aiohttp.TCPConnector(limit=4, enable_cleanup_closed=True)
+            )
+        return self.http_session
+
+    async def get_current_url(self) -> str:
+        """URL of the most recently active Chrome tab, or "" if it cannot be read"""
+        try:
+            async with self._session().get("http://localhost:9222/json/list") as response:
+                targets = await response.json()
+        except Exception as e:
+            logger.warning("Could not read current page URL: %s", e)
+            return ""
+
+        # Chrome lists targets most recently activated first
+        return next((t.get("url", "") for t in targets if t.get("type") == "page"), "")
+
+    async def _wait_for_debug_port(self, deadline_s: float = 20.0):
+        """Wait for Chrome debug port to be ready, polling with exponential backoff"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + deadline_s
+        delay = 0.05
+        attempt = 0
+        last_error = None
+
+        while True:
+            attempt += 1
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get("http://localhost:9222/json/version", timeout=2) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            print(f"Chrome debug port ready: {data.get('Browser', 'Unknown')}")
-                            return
+                async with self._session().get("http://localhost:9222/json/version") as response:
+                    if response.status == 200:
+                        # A 200 is all we need; the body is only parsed for the log line
+                        body = await response.read()
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info("Chrome debug port ready: %s", orjson.loads(body).get("Browser", "Unknown"))
+                        return
+                    last_error = f"HTTP {response.status}"
             except Exception as e:
-                print(f"Attempt {attempt + 1}/{max_retries}: Chrome debug port not ready - {e}")
-                await asyncio.sleep(2)
+                last_error = e
+
+            if attempt == 1:
+                logger.info("Chrome debug port not ready yet - %s", last_error)
+            if loop.time() + delay > deadline:
+                break
+            await asyncio.sleep(delay)
+            delay = min(delay * 1.7, 0.5)
 
-        raise Exception("Chrome debug port not available after maximum retries")
+        raise Exception(f"Chrome debug port not available after {attempt} attempts ({deadline_s}s): {last_error}")
 
     def get_agent(self):
         """Get the browser-use agent instance - DEPRECATED"""
-        print("get_agent is deprecated as agents are now created per-task")
+        logger.warning("get_agent is deprecated as agents are now created per-task")
         return None
\ No newline at end of file
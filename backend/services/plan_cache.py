@@ -0,0 +1,82 @@
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class PlanCache:
+    """Disk-backed cache of successful task runs, keyed by instruction and starting page"""
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 3600, max_bytes: int = 100 * 1024 * 1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # fingerprint -> {"created": epoch seconds, "steps": [...], "result": ...}, oldest first
+        self.entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self._load()
+
+    @staticmethod
+    def fingerprint(instruction: str, url: str = "") -> str:
+        """Stable key for an instruction issued against a given page"""
+        normalized = " ".join(instruction.lower().split())
+        return hashlib.sha256(f"{normalized}\n{url}".encode()).hexdigest()
+
+    def get(self, fp: str) -> Optional[Dict]:
+        """Cached entry for fp, or None if missing or expired"""
+        entry = self.entries.get(fp)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            del self.entries[fp]
+            return None
+        return entry
+
+    def put(self, fp: str, steps: List[Dict], result: Any = None):
+        """Store the steps and final result of a successful run"""
+        self.entries.pop(fp, None)
+        self.entries[fp] = {"created": time.time(), "steps": steps, "result": result}
+
+    def save(self):
+        """Write the cache atomically, evicting oldest entries past the size cap"""
+        now = time.time()
+        for fp in [fp for fp, entry in self.entries.items() if now - entry["created"] > self.ttl]:
+            del self.entries[fp]
+
+        data = orjson.dumps(self.entries)
+        while len(data) > self.max_bytes and self.entries:
+            self.entries.popitem(last=False)
+            data = orjson.dumps(self.entries)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+    def _load(self):
+        """Read a previously saved cache, ignoring a missing or corrupt file"""
+        try:
+            with open(self.path, "rb") as f:
+                entries = orjson.loads(f.read())
+            if not isinstance(entries, dict):
+                raise ValueError(f"expected an object, got {type(entries).__name__}")
+            for fp, entry in entries.items():
+                if not (
+                    isinstance(entry, dict)
+                    and isinstance(entry.get("created"), (int, float))
+                    and isinstance(entry.get("steps"), list)
+                ):
+                    raise ValueError(f"malformed entry {fp!r}")
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning("Ignoring unreadable plan cache %s: %s", self.path, e)
+            return
+
+        for fp, entry in sorted(entries.items(), key=lambda item: item[1]["created"]):
+            self.entries[fp] = entry
@@ -0,0 +1,88 @@
+import asyncio
+import contextlib
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PubSubService:
+    """Service for fanning out broadcasts across uvicorn workers via Redis pub/sub"""
+
+    def __init__(self, on_message: Callable[[bytes], Awaitable[None]], channel: str = "events"):
+        self.on_message = on_message
+        self.channel = channel
+        self.redis = None
+        self.pubsub = None
+        self.listener: Optional[asyncio.Task] = None
+
+        # Configuration from environment
+        self.redis_url = os.getenv("REDIS_URL", "redis://localhost")
+
+    async def start(self):
+        """Connect to Redis and forward channel messages to local connections"""
+        import redis.asyncio as redis
+
+        try:
+            self.redis = redis.from_url(self.redis_url)
+            self.pubsub = self.redis.pubsub()
+            await self.pubsub.subscribe(self.channel)
+            self.listener = asyncio.create_task(self._listen())
+
+            logger.info("PubSub service subscribed to '%s' on %s", self.channel, self.redis_url)
+
+        except Exception as e:
+            logger.error("Error starting pubsub service: %s", e)
+            await self.stop()
+            raise
+
+    async def stop(self):
+        """Stop listening and close the Redis connection"""
+        try:
+            if self.listener:
+                self.listener.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await self.listener
+            if self.pubsub:
+                await self.pubsub.aclose()
+            if self.redis:
+                await self.redis.aclose()
+        except Exception as e:
+            logger.error("Error stopping pubsub service: %s", e)
+
+    async def publish(self, data: bytes):
+        """Publish a serialized message to every worker"""
+        await self.redis.publish(self.channel, data)
+
+    async def _listen(self):
+        """Forward every published message to this worker's sockets, resubscribing if Redis drops"""
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        await self.on_message(message["data"])
+                    except Exception as e:
+                        logger.error("Error forwarding pubsub message: %s", e)
+                logger.warning("PubSub listener on '%s' ended", self.channel)
+            except Exception as e:
+                logger.error("PubSub connection lost: %s", e)
+            await self._resubscribe()
+
+    async def _resubscribe(self, max_backoff: float = 30.0):
+        """Replace the broken PubSub with a fresh subscription, backing off between attempts"""
+        backoff = 0.5
+        while True:
+            await asyncio.sleep(backoff)
+            try:
+                with contextlib.suppress(Exception):
+                    await self.pubsub.aclose()
+                self.pubsub = self.redis.pubsub()
+                await self.pubsub.subscribe(self.channel)
+                logger.info("PubSub resubscribed to '%s'", self.channel)
+                return
+            except Exception as e:
+                backoff = min(backoff * 2, max_backoff)
+                logger.error("Error resubscribing to '%s', retrying in %.1fs: %s", self.channel, backoff, e)
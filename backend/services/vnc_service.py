@@ -1,143 +1,226 @@
 import asyncio
+import contextlib
+import logging
 import os
-import subprocess
-from typing import Dict, Optional
+import shutil
+import signal
+from asyncio.subprocess import DEVNULL, Process
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Resolved once at import instead of a $PATH walk on every spawn
+_XVFB = shutil.which("Xvfb") or "/usr/bin/Xvfb"
+_X11VNC = shutil.which("x11vnc") or "/usr/bin/x11vnc"
+
+
+def _kill_existing(program: str, display: str) -> List[int]:
+    """SIGTERM leftover instances of program on display, reading /proc instead of forking pkill"""
+    pids = []
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(os.path.join(entry.path, "cmdline"), "rb") as f:
+                argv = f.read().split(b"\0")
+        except OSError:
+            continue  # Process exited or is not ours to inspect
+        if os.path.basename(argv[0]) == program.encode() and display.encode() in argv:
+            try:
+                os.kill(int(entry.name), signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                continue
+            pids.append(int(entry.name))
+    return pids
+
+
+def _pid_alive(pid: int) -> bool:
+    """True while pid exists and is not a zombie"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            # State follows the parenthesised command name
+            return f.read().rsplit(b")", 1)[1].split()[0] != b"Z"
+    except (OSError, IndexError):
+        return False
+
+
+async def _wait_for_exit(pids: List[int], timeout: float = 2.0):
+    """Wait for signalled pids to exit, escalating to SIGKILL after timeout"""
+    try:
+        async with asyncio.timeout(timeout):
+            while any(_pid_alive(pid) for pid in pids):
+                await asyncio.sleep(0.01)
+        return
+    except TimeoutError:
+        pass
+    for pid in pids:
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            os.kill(pid, signal.SIGKILL)
+    with contextlib.suppress(TimeoutError):
+        async with asyncio.timeout(timeout):
+            while any(_pid_alive(pid) for pid in pids):
+                await asyncio.sleep(0.01)
 
 
 class VNCService:
     """Service for managing VNC server for remote browser display"""
 
     def __init__(self):
-        self.vnc_process: Optional[subprocess.Popen] = None
-        self.display_process: Optional[subprocess.Popen] = None
+        self.vnc_process: Optional[Process] = None
+        self.display_process: Optional[Process] = None
 
         # Configuration from environment
         self.vnc_port = int(os.getenv("VNC_PORT", "5901"))
         self.vnc_password = os.getenv("VNC_PASSWORD", "webagent")
         self.vnc_display = os.getenv("VNC_DISPLAY", ":1")
+        self.password_file = "/tmp/vncpasswd"
         self.width = int(os.getenv("BROWSER_WIDTH", "1920"))
         self.height = int(os.getenv("BROWSER_HEIGHT", "1080"))
 
     async def start(self):
         """Start VNC server and virtual display"""
         try:
-            # Start virtual display (Xvfb)
-            await self._start_virtual_display()
+            # Start virtual display (Xvfb); the password file does not need it, so write it meanwhile
+            await asyncio.gather(self._start_virtual_display(), self._write_vnc_password())
 
             # Start VNC server
             await self._start_vnc_server()
 
-            print(f"VNC service started on display {self.vnc_display}:{self.vnc_port}")
+            logger.info("VNC service started on display %s:%s", self.vnc_display, self.vnc_port)
 
         except Exception as e:
-            print(f"Error starting VNC service: {e}")
+            logger.error("Error starting VNC service: %s", e)
             await self.stop()
             raise
 
     async def _start_virtual_display(self):
         """Start Xvfb virtual display"""
         try:
-            # Kill any existing display
-            subprocess.run(
-                ["pkill", "-f", f"Xvfb.*{self.vnc_display}"],
-                capture_output=True
-            )
+            # Kill any existing display and wait for it to go, so its socket cannot pass the readiness probe
+            await _wait_for_exit(_kill_existing("Xvfb", self.vnc_display))
+
+            # A display that died uncleanly leaves its lock and socket behind, which would also block Xvfb
+            display_number = self.vnc_display.lstrip(":")
+            for stale in (f"/tmp/.X{display_number}-lock", f"/tmp/.X11-unix/X{display_number}"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stale)
 
             # Start Xvfb
-            self.display_process = subprocess.Popen([
-                "Xvfb",
+            self.display_process = await asyncio.create_subprocess_exec(
+                _XVFB,
                 self.vnc_display,
                 "-screen", "0", f"{self.width}x{self.height}x24",
                 "-ac",
-                "+extension", "GLX",
-                "+render",
-                "-noreset"
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                "-noreset",
+                # Chrome renders with SwiftShader, so no GLX; clients use the local socket only
+                "-nolisten", "tcp",
+                stdout=DEVNULL, stderr=DEVNULL
+            )
 
-            # Wait a bit for display to start
-            await asyncio.sleep(2)
+            # Ready once the display's X socket exists
+            await self._wait_until_ready(self.display_process, self._display_socket_exists)
 
             # Set DISPLAY environment variable
             os.environ["DISPLAY"] = self.vnc_display
 
-            print(f"Virtual display started: {self.vnc_display}")
+            logger.info("Virtual display started: %s", self.vnc_display)
 
         except Exception as e:
-            print(f"Error starting virtual display: {e}")
+            logger.error("Error starting virtual display: %s", e)
             raise
 
+    async def _write_vnc_password(self):
+        """Create the VNC password file"""
+        storepasswd = await asyncio.create_subprocess_exec(
+            _X11VNC, "-storepasswd", self.vnc_password, self.password_file,
+            stdout=DEVNULL, stderr=DEVNULL
+        )
+        if await storepasswd.wait() != 0:
+            raise Exception(f"x11vnc -storepasswd failed with exit code {storepasswd.returncode}")
+
     async def _start_vnc_server(self):
         """Start VNC server (x11vnc)"""
         try:
-            # Kill any existing VNC server
-            subprocess.run(
-                ["pkill", "-f", f"x11vnc.*{self.vnc_display}"],
-                capture_output=True
-            )
+            # Kill any existing VNC server and wait for it to release the RFB port
+            await _wait_for_exit(_kill_existing("x11vnc", self.vnc_display))
 
-            # Create VNC password file
-            password_file = "/tmp/vncpasswd"
-            subprocess.run([
-                "x11vnc", "-storepasswd", self.vnc_password, password_file
-            ], check=True)
-
-            # Start x11vnc
-            self.vnc_process = subprocess.Popen([
-                "x11vnc",
+            # Start x11vnc in the foreground so vnc_process is the server itself and stop() can signal it
+            self.vnc_process = await asyncio.create_subprocess_exec(
+                _X11VNC,
                 "-display", self.vnc_display,
                 "-rfbport", str(self.vnc_port),
-                "-passwd", password_file,
+                "-passwd", self.password_file,
                 "-shared",
                 "-forever",
                 "-noxdamage",
                 "-noxfixes",
                 "-noxcomposite",
-                "-bg",
-                "-nopw"  # Remove this if you want password protection
-            ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                "-threads",  # Scan and encode on separate threads
+                "-nosel",  # No clipboard sync
+                "-nopw",  # Remove this if you want password protection
+                stdout=DEVNULL, stderr=DEVNULL
+            )
 
-            # Wait for VNC server to start
-            await asyncio.sleep(2)
+            # Ready once the RFB port accepts connections
+            await self._wait_until_ready(self.vnc_process, self._vnc_port_open)
 
-            print(f"VNC server started on port {self.vnc_port}")
+            logger.info("VNC server started on port %s", self.vnc_port)
 
         except Exception as e:
-            print(f"Error starting VNC server: {e}")
+            logger.error("Error starting VNC server: %s", e)
             raise
 
+    async def _wait_until_ready(self, process: Process, probe, timeout: float = 5.0, settle: float = 0.05):
+        """Poll probe() every 10 ms until it succeeds, the process exits, or timeout passes"""
+        try:
+            async with asyncio.timeout(timeout):
+                while process.returncode is None and not await probe():
+                    await asyncio.sleep(0.01)
+                # The probe only proves someone is listening; make sure our child is still alive
+                if process.returncode is None:
+                    with contextlib.suppress(TimeoutError):
+                        await asyncio.wait_for(asyncio.shield(process.wait()), settle)
+        except TimeoutError:
+            raise Exception(f"Process not ready after {timeout}s") from None
+        if process.returncode is not None:
+            raise Exception(f"Process exited during startup with code {process.returncode}")
+
+    async def _display_socket_exists(self) -> bool:
+        """Xvfb listens on /tmp/.X11-unix/X<n> once the display is up"""
+        return os.path.exists(f"/tmp/.X11-unix/X{self.vnc_display.lstrip(':')}")
+
+    async def _vnc_port_open(self) -> bool:
+        """x11vnc is up once its RFB port accepts a connection"""
+        try:
+            _, writer = await asyncio.open_connection("localhost", self.vnc_port)
+        except OSError:
+            return False
+        writer.close()
+        await writer.wait_closed()
+        return True
+
+    async def _terminate(self, process: Optional[Process]):
+        """SIGTERM a child, escalating to SIGKILL if it has not exited within 5 seconds"""
+        if process is None or process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
     async def stop(self):
         """Stop VNC server and virtual display"""
         try:
-            # Stop VNC server
-            if self.vnc_process:
-                self.vnc_process.terminate()
-                try:
-                    self.vnc_process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    self.vnc_process.kill()
-
-            # Stop virtual display
-            if self.display_process:
-                self.display_process.terminate()
-                try:
-                    self.display_process.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    self.display_process.kill()
-
-            # Kill any remaining processes
-            subprocess.run(
-                ["pkill", "-f", f"x11vnc.*{self.vnc_display}"],
-                capture_output=True
-            )
-            subprocess.run(
-                ["pkill", "-f", f"Xvfb.*{self.vnc_display}"],
-                capture_output=True
-            )
+            # Stop VNC server, then the display it is attached to
+            await self._terminate(self.vnc_process)
+            await self._terminate(self.display_process)
 
-            print("VNC service stopped")
+            logger.info("VNC service stopped")
 
         except Exception as e:
-            print(f"Error stopping VNC service: {e}")
+            logger.error("Error stopping VNC service: %s", e)
 
     def get_connection_info(self) -> Dict:
         """Get VNC connection information for clients"""
@@ -155,8 +238,8 @@ class VNCService:
         try:
             if self.vnc_process and self.display_process:
                 return (
-                    self.vnc_process.poll() is None and
-                    self.display_process.poll() is None
+                    self.vnc_process.returncode is None and
+                    self.display_process.returncode is None
                 )
             return False
         except:
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import anyio
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.types import Scope
+
+try:
+    import brotli
+except ImportError:  # Optional - compressed variants fall back to gzip
+    brotli = None
+
+# Media types worth compressing; images and fonts are already compressed
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+MIN_COMPRESS_SIZE = 512
+
+
+@dataclass(slots=True)
+class CachedFile:
+    """In-memory copy of a static file with its precomputed variants"""
+    body: bytes
+    media_type: str
+    digest: str
+    br: Optional[bytes] = None
+    gzip: Optional[bytes] = None
+
+    @classmethod
+    def from_bytes(cls, body: bytes, media_type: str) -> "CachedFile":
+        """Precompute the digest and, for compressible types, the br and gzip variants"""
+        cached = cls(body=body, media_type=media_type, digest=hashlib.sha1(body).hexdigest())
+        if len(body) >= MIN_COMPRESS_SIZE and media_type.startswith(COMPRESSIBLE_TYPES):
+            # Keep gzip alongside br for clients that do not accept brotli
+            cached.gzip = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli:
+                mode = brotli.MODE_TEXT if media_type.startswith("text/") else brotli.MODE_GENERIC
+                cached.br = brotli.compress(body, quality=11, mode=mode)
+        return cached
+
+
+def _encoding_qvalues(accept_encoding: str) -> Dict[str, float]:
+    """Parse Accept-Encoding into {coding: q}"""
+    qvalues = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    return qvalues
+
+
+def _negotiate(cached: CachedFile, accept_encoding: str) -> str:
+    """Pick the content coding with the highest q, preferring br, then gzip, then identity on ties"""
+    qvalues = _encoding_qvalues(accept_encoding)
+    wildcard = qvalues.get("*")
+
+    def quality(coding: str) -> float:
+        if coding in qvalues:
+            return qvalues[coding]
+        if wildcard is not None:
+            return wildcard
+        return 1.0 if coding == "identity" else 0.0
+
+    candidates = [c for c, body in (("br", cached.br), ("gzip", cached.gzip)) if body is not None]
+    best = max(candidates + ["identity"], key=quality)
+    return best if quality(best) > 0 else "identity"
+
+
+def respond(cached: CachedFile, request_headers: Headers, cache_control: str) -> Response:
+    """Build a 304, compressed or plain response for a cached file.
+
+    Each representation gets its own strong ETag, so a validator never
+    matches bytes in a different encoding.
+    """
+    coding = _negotiate(cached, request_headers.get("accept-encoding", ""))
+    etag = f'"{cached.digest}"' if coding == "identity" else f'"{cached.digest}-{coding}"'
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if cached.gzip is not None:
+        headers["Vary"] = "Accept-Encoding"
+
+    # If-None-Match uses weak comparison and may list several tags or "*"
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+    if coding == "identity":
+        return Response(cached.body, media_type=cached.media_type, headers=headers)
+    headers["Content-Encoding"] = coding
+    return Response(cached.br if coding == "br" else cached.gzip, media_type=cached.media_type, headers=headers)
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles that keeps each served file in memory after the first hit.
+
+    For per-deploy assets such as noVNC: later requests skip the stat/open/read
+    syscalls entirely and can get a precompressed body. The URLs are not
+    versioned, so browsers revalidate with the ETag rather than caching blindly.
+    """
+
+    def __init__(self, *args, cache_control: str = "no-cache", **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+        self.files: Dict[str, CachedFile] = {}
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        """Serve from memory, loading the file through StaticFiles on a miss"""
+        cached = self.files.get(path)
+        if cached is None or scope["method"] not in ("GET", "HEAD"):
+            response = await super().get_response(path, scope)
+            if not isinstance(response, FileResponse) or response.status_code != 200:
+                return response
+            cached = await anyio.to_thread.run_sync(self._load, response.path, response.media_type)
+            self.files[path] = cached
+
+        return respond(cached, Headers(scope=scope), self.cache_control)
+
+    def _load(self, full_path: str, media_type: str) -> CachedFile:
+        """Read a file once and precompute its ETag and compressed variants"""
+        with open(full_path, "rb") as f:
+            return CachedFile.from_bytes(f.read(), media_type)
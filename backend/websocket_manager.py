@@ -1,31 +1,183 @@
-from typing import List
-from fastapi import WebSocket
+import asyncio
+import logging
+from typing import AsyncIterator, Dict, List, Set
+
+import orjson
+from fastapi import WebSocket, WebSocketDisconnect
+
+logger = logging.getLogger(__name__)
 
 
 class ConnectionManager:
     """Manages WebSocket connections"""
 
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, queue_size: int = 256, batch_window: float = 0.005, batch_size: int = 32):
+        # Each connection owns a bounded outbound queue drained by its own writer task
+        self.active_connections: Dict[WebSocket, asyncio.Queue] = {}
+        self.writers: Dict[WebSocket, asyncio.Task] = {}
+        # Sockets subscribed to each task, so task-scoped messages skip unrelated clients
+        self.subscribers: Dict[str, Set[WebSocket]] = {}
+        # Optional cross-worker fan-out (PubSubService); None means this process only
+        self.backplane = None
+        # Strong refs to fire-and-forget broadcasts so they are not garbage collected mid-flight
+        self.background_tasks: Set[asyncio.Task] = set()
+        self.queue_size = queue_size
+        self.batch_window = batch_window
+        self.batch_size = batch_size
 
     async def connect(self, websocket: WebSocket):
         """Accept a new WebSocket connection"""
         await websocket.accept()
-        self.active_connections.append(websocket)
+        websocket.state.host = websocket.headers.get('host', 'localhost').partition(':')[0]
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.active_connections[websocket] = queue
+        self.writers[websocket] = asyncio.create_task(self._writer(websocket, queue))
 
     def disconnect(self, websocket: WebSocket):
         """Remove a WebSocket connection"""
-        self.active_connections.remove(websocket)
+        self.active_connections.pop(websocket, None)
+        writer = self.writers.pop(websocket, None)
+        if writer and writer is not asyncio.current_task():
+            writer.cancel()
 
     async def send_personal_message(self, message: dict, websocket: WebSocket):
         """Send a message to a specific WebSocket"""
-        await websocket.send_json(message)
+        await self.send_serialized(orjson.dumps(message), websocket)
+
+    async def send_serialized(self, data: bytes, websocket: WebSocket):
+        """Send an already-serialized message to a specific WebSocket"""
+        queue = self.active_connections.get(websocket)
+        if queue is None:
+            # Writer already dropped this socket; let the producer stop early
+            raise WebSocketDisconnect(code=1006)
+        await queue.put(data)
+
+    def register_task(self, task_id: str, websocket: WebSocket):
+        """Subscribe this WebSocket to task-scoped messages for task_id"""
+        self.subscribers.setdefault(task_id, set()).add(websocket)
+
+    def unregister_task(self, task_id: str, websocket: WebSocket):
+        """Unsubscribe this WebSocket from task_id, dropping the topic once empty"""
+        sockets = self.subscribers.get(task_id)
+        if sockets is None:
+            return
+        sockets.discard(websocket)
+        if not sockets:
+            del self.subscribers[task_id]
+
+    async def send_to_task(self, task_id: str, message: dict) -> bool:
+        """Send a message to the WebSockets subscribed to task_id, if any"""
+        sockets = self.subscribers.get(task_id)
+        if not sockets:
+            return False
+        await self._fan_out(orjson.dumps(message), sockets)
+        return True
+
+    async def send_batched(self, messages: AsyncIterator[dict], websocket: WebSocket):
+        """Stream messages to a specific WebSocket, coalescing bursts into batch frames.
+
+        If the client goes away mid-stream the source generator is closed right away,
+        so no more AI work is done for a consumer that is gone.
+        """
+        loop = asyncio.get_running_loop()
+        iterator = messages.__aiter__()
+        batch: List[dict] = []
+        deadline = 0.0
+        pending = asyncio.ensure_future(iterator.__anext__())
+
+        try:
+            while True:
+                # Block for the first message, then wait at most until the batch window closes
+                timeout = max(deadline - loop.time(), 0) if batch else None
+                done, _ = await asyncio.wait({pending}, timeout=timeout)
+
+                if done:
+                    try:
+                        message = pending.result()
+                    except StopAsyncIteration:
+                        break
+                    if not batch:
+                        deadline = loop.time() + self.batch_window
+                    batch.append(message)
+                    pending = asyncio.ensure_future(iterator.__anext__())
+                    if len(batch) < self.batch_size:
+                        continue
+
+                await self._send_batch(batch, websocket)
+                batch = []
+
+            if batch:
+                await self._send_batch(batch, websocket)
+        finally:
+            if not pending.done():
+                pending.cancel()
+                await asyncio.wait({pending})
+            if hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+    async def _send_batch(self, batch: List[dict], websocket: WebSocket):
+        """Send one message as-is, or several wrapped in a single batch frame"""
+        if len(batch) == 1:
+            await self.send_personal_message(batch[0], websocket)
+        else:
+            await self.send_personal_message({"type": "batch", "items": batch}, websocket)
 
     async def broadcast(self, message: dict):
-        """Broadcast a message to all connected WebSockets"""
-        for connection in self.active_connections:
+        """Broadcast a message to all connected WebSockets, across workers if a backplane is set"""
+        data = orjson.dumps(message)
+        if self.backplane:
+            await self.backplane.publish(data)
+        else:
+            await self.local_broadcast(data)
+
+    def broadcast_nowait(self, message: dict):
+        """Schedule a broadcast without making the caller wait on the fan-out"""
+        task = asyncio.create_task(self._broadcast_safely(message))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def _broadcast_safely(self, message: dict):
+        """Broadcast from a background task; errors are logged, never raised"""
+        try:
+            await self.broadcast(message)
+        except Exception as e:
+            logger.error("Error broadcasting message: %s", e)
+
+    async def local_broadcast(self, data: bytes):
+        """Broadcast a serialized message to the WebSockets connected to this process"""
+        await self._fan_out(data, self.active_connections)
+
+    async def _fan_out(self, data: bytes, connections):
+        """Enqueue a serialized message for each connection, dropping clients that fall behind"""
+        # Enqueue only; no per-message tasks, slow clients never block the caller.
+        # The loop body never awaits, so the collection cannot change while we iterate it.
+        slow = []
+        for connection in connections:
+            queue = self.active_connections.get(connection)
+            if queue is None:
+                continue
             try:
-                await connection.send_json(message)
-            except:
-                # Remove broken connections
-                self.active_connections.remove(connection)
\ No newline at end of file
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                slow.append(connection)
+
+        if slow:
+            await asyncio.gather(*(self._drop(connection) for connection in slow))
+
+    async def _drop(self, websocket: WebSocket):
+        """Disconnect a client that cannot keep up instead of buffering without bound"""
+        self.disconnect(websocket)
+        try:
+            await websocket.close(code=1013)
+        except Exception:
+            pass
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Drain a connection's outbound queue onto its socket"""
+        try:
+            while True:
+                data = await queue.get()
+                await websocket.send_bytes(data)
+        except Exception:
+            # Remove broken connections
+            self.disconnect(websocket)
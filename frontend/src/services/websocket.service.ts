@@ -3,10 +3,13 @@ import { WebSocketMessage } from '../types';
 class WebSocketService {
   private socket: WebSocket | null = null;
   private messageHandlers: Map<string, (message: WebSocketMessage) => void> = new Map();
+  private decoder = new TextDecoder();
 
   connect(url: string = `ws://${window.location.hostname}:${window.location.port}/ws`): Promise<void> {
     return new Promise((resolve, reject) => {
       this.socket = new WebSocket(url);
+      // The server sends every frame as binary JSON bytes
+      this.socket.binaryType = 'arraybuffer';
 
       this.socket.onopen = () => {
         console.log('WebSocket connected');
@@ -25,7 +28,10 @@ class WebSocketService {
 
       this.socket.onmessage = (event) => {
         try {
-          const message: WebSocketMessage = JSON.parse(event.data);
+          const text = typeof event.data === 'string'
+            ? event.data
+            : this.decoder.decode(event.data as ArrayBuffer);
+          const message: WebSocketMessage = JSON.parse(text);
           this.handleMessage(message);
         } catch (error) {
           console.error('Error parsing WebSocket message:', error);
@@ -72,6 +78,12 @@ class WebSocketService {
   }
 
   private handleMessage(message: WebSocketMessage) {
+    // The server coalesces bursts of updates into a single batch frame
+    if (message.type === 'batch') {
+      (message.items || []).forEach(item => this.handleMessage(item));
+      return;
+    }
+
     const handler = this.messageHandlers.get(message.type);
     if (handler) {
       handler(message);
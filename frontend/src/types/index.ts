@@ -18,7 +18,7 @@ export interface TaskStep {
 }
 
 export interface WebSocketMessage {
-  type: 'task_created' | 'task_update' | 'step_update' | 'task_complete' | 'error' | 'vnc_info';
+  type: 'task_created' | 'task_update' | 'step_update' | 'task_complete' | 'error' | 'vnc_info' | 'batch';
   task_id?: string;
   status?: string;
   message?: string;
@@ -27,6 +27,7 @@ export interface WebSocketMessage {
   step_number?: number;
   action?: string;
   description?: string;
+  items?: WebSocketMessage[];
 }
 
 export interface VNCInfo {
@@ -32,8 +32,9 @@ def start_browser():
             headless=False,
             args=["--no-sandbox", "--disable-dev-shm-usage"]
         )
-        page = browser.get_page()
-        page.goto("https://google.com")
+        page = browser.new_page()
+        # Return once the document is parsed instead of waiting for every subresource
+        page.goto("https://google.com", wait_until="domcontentloaded", timeout=15000)
         print("✅ Browser started on display :99")
 
         # Keep browser open